@@ -108,6 +108,17 @@ layers = ['relu1']
 # layers = ['maxpool1', 'maxpool2', 'relu3', 'fc2']
 # layers = ['gs1', 'gs2', 'gs3', 'fc']
 
+
+def identity_forward(x):
+    """Forward pass of the all-identity net. Only call the layers used by DkNN
+    so that their hooks still see the input, skip the rest of the net."""
+    for layer in layers:
+        getattr(net, layer)(x)
+    return x
+
+
+net.forward = identity_forward
+
 # net = net.cpu()
 with torch.no_grad():
     # dknn = DKNN(net, x_train, y_train, x_valid, y_valid, layers,
@@ -1,25 +1,75 @@
 '''Implement gradient-based attack on DkNN with L-inf constraint'''
 
+import functools
 import logging
+from typing import List
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
 
+import faiss
+
 INFTY = 1e20
 
 
+def _loss_function(x, reps: List[torch.Tensor],
+                   guide_reps: List[torch.Tensor],
+                   guide_norms2: List[torch.Tensor], const, x_recon,
+                   adv_loss_buf):
+    """Body of DKNNLinfAttack.loss_function, compiled with TorchScript by
+    _scripted_loss_function. <reps>, <guide_reps> and <guide_norms2> are
+    lists with one entry per layer."""
+
+    batch_size = x.size(0)
+    # detach so that autograd history does not build up on the buffer
+    # across iterations
+    adv_loss = adv_loss_buf.detach()
+    # find squared L-2 distance between original samples and their
+    # adversarial examples at each layer, expanded as
+    # ||r||^2 + ||g||^2 - 2 * <r, g> so that it reduces to one bmm
+    for l in range(len(reps)):
+        assert guide_reps[l].is_contiguous()
+        rep = reps[l].view(batch_size, -1)
+        r2 = rep.pow(2).sum(1, keepdim=True)
+        dots = torch.bmm(guide_reps[l], rep.unsqueeze(-1)).squeeze(-1)
+        adv_loss[:, l] = (r2 + guide_norms2[l] - 2 * dots).sum(1)
+    # find L-inf norm squared of perturbation
+    dist = F.relu(torch.abs(x - x_recon) - 0.1)
+    dist = dist.pow(2).view(batch_size, -1).mean(1)
+    # total_loss is sum of squared perturbation norm and squared distance
+    # of representations, multiplied by constant
+    total_loss = const * dist + adv_loss.mean(1)
+
+    return total_loss.mean(), dist.sqrt()
+
+
+@functools.lru_cache(maxsize=None)
+def _scripted_loss_function():
+    """Script _loss_function on first use instead of on every import"""
+    return torch.jit.script(_loss_function)
+
+
 class DKNNLinfAttack(object):
     """
     Implement gradient-based attack on Deep k-Nearest Neigbhor that uses
     L-2 distance as a metric. Perturbation is constrained in an L-inf ball.
     """
 
+    def __init__(self):
+        # cache of labels and per-class faiss selectors derived from the
+        # training set of the last DkNN attacked so that they are not rebuilt
+        # on every call
+        self._dknn = None
+        self._y_train = None
+        self._class_selectors = None
+
     def __call__(self, dknn, x_orig, label, guide_layer='relu1', m=100,
                  binary_search_steps=5, max_iterations=500,
                  learning_rate=1e-2, initial_const=1, abort_early=True,
-                 max_linf=None, random_start=False, guide_mode=1):
+                 max_linf=None, random_start=False, guide_mode=1,
+                 cuda_graph=False, fp16_guide=False):
         """
         Parameters
         ----------
@@ -62,6 +112,16 @@ class DKNNLinfAttack(object):
             the same class but not equal its original label.
             - guide_mode == 2: find the nearest neighbor that has a different
             class from the input and find its m - 1 neighbors
+        cuda_graph : bool, optional
+            whether or not to capture one optimization step in a CUDA graph
+            and replay it instead of running the step eagerly. Only works
+            when the model runs on a single GPU (e.g. not wrapped in
+            DataParallel). Default is False
+        fp16_guide : bool, optional
+            whether or not to encode the guide samples under float16 autocast
+            when the DkNN is on a GPU. Guide representations are still stored
+            in float32 but are computed with lower precision, so results
+            differ slightly from the float32 encoding. Default is False
 
         Returns
         -------
@@ -77,13 +137,17 @@ class DKNNLinfAttack(object):
         batch_size = x_orig.size(0)
         x_adv = x_orig.clone()
         label = label.cpu().numpy()
-        input_shape = x_orig.detach().cpu().numpy().shape
         device = dknn.device
+        on_cuda = torch.device(device).type == 'cuda'
+        if cuda_graph and not on_cuda:
+            raise ValueError("cuda_graph requires the DkNN to be on a GPU")
+
+        # constants of the affine map between [min_, max_] and [-1, +1]
+        a = ((min_ + max_) / 2).detach()
+        b = ((max_ - min_) / 2).detach()
 
         def to_attack_space(x):
             # map from [min_, max_] to [-1, +1]
-            a = (min_ + max_) / 2
-            b = (max_ - min_) / 2
             x = (x - a) / b
 
             # from [-1, +1] to approx. (-1, +1)
@@ -97,15 +161,8 @@ class DKNNLinfAttack(object):
             to the model space. This transformation and
             the returned gradient are elementwise."""
 
-            # from (-inf, +inf) to (-1, +1)
-            x = torch.tanh(x)
-
-            # map from (-1, +1) to (min_, max_)
-            a = (min_ + max_) / 2
-            b = (max_ - min_) / 2
-            x = x * b + a
-
-            return x
+            # from (-inf, +inf) to (-1, +1), then map to (min_, max_)
+            return torch.tanh(x).mul(b).add_(a)
 
         # variables representing inputs in attack space will be prefixed with z
         z_orig = to_attack_space(x_orig)
@@ -116,9 +173,12 @@ class DKNNLinfAttack(object):
         const += initial_const
         lower_bound = torch.zeros_like(const)
         upper_bound = torch.zeros_like(const) + INFTY
-
         with torch.no_grad():
 
+            # whether x_adv holds an adversarial example, which is already the
+            # case for inputs that the DkNN misclassifies
+            found = self.check_adv(dknn, x_orig, label).bool()
+
             # choose guide samples and get their representations
             if guide_mode == 1:
                 x_guide = self.find_guide_samples(
@@ -129,84 +189,128 @@ class DKNNLinfAttack(object):
             else:
                 raise ValueError("Invalid guide_mode (choose between 1 and 2)")
 
-            guide_reps = {}
-            for i in range(batch_size):
+            # encode guide samples of the whole batch in one forward pass
+            with torch.autocast(device_type='cuda', dtype=torch.float16,
+                                enabled=(fp16_guide and on_cuda)):
                 guide_rep = dknn.get_activations(
-                    x_guide[i], requires_grad=False)
-                for layer in dknn.layers:
-                    if i == 0:
-                        # set a zero tensor before filling it
-                        size = (batch_size, ) + \
-                            guide_rep[layer].view(m, -1).size()
-                        guide_reps[layer] = torch.zeros(size, device=device)
-                    guide_reps[layer][i] = guide_rep[layer].view(
-                        m, -1).detach()
+                    x_guide.reshape(-1, *x_guide.shape[2:]),
+                    requires_grad=False)
+            guide_reps = {}
+            guide_norms2 = {}
+            for layer in dknn.layers:
+                guide_reps[layer] = guide_rep[layer].view(
+                    batch_size, m, -1).contiguous()
+                guide_norms2[layer] = (
+                    guide_reps[layer].pow(2).sum(-1).contiguous())
+
+        # buffer reused by every call of loss_function
+        adv_loss_buf = torch.empty((batch_size, len(dknn.layers)),
+                                   device=device)
+
+        # progress is reported and checked after each tenth of the iterations
+        check_every = int(np.ceil(max_iterations / 10))
+
+        # the perturbation and its optimizer are shared by all binary search
+        # steps and reset in place at the start of each step
+        z_delta = torch.zeros_like(z_orig, requires_grad=True)
+        if cuda_graph:
+            optimizer = optim.Adam([z_delta], lr=learning_rate,
+                                   capturable=True)
+        else:
+            optimizer = optim.Adam([z_delta], lr=learning_rate)
+        # optimizer = optim.SGD([z_delta], lr=learning_rate)
+
+        def optimize_step():
+            x = to_model_space(z_orig + z_delta)
+            reps = dknn.get_activations(x, requires_grad=True)
+            loss, l2dist = self.loss_function(
+                x, reps, guide_reps, guide_norms2, dknn.layers, const,
+                x_recon, adv_loss_buf)
+            loss.backward()
+            optimizer.step()
+            return x, loss, l2dist
+
+        if cuda_graph:
+            # warm up on a side stream so that the optimizer state and cuDNN
+            # are initialized, then capture one step. All tensors the step
+            # reads (z_delta, const, guide_reps, optimizer state) must only be
+            # updated in place from now on. The warm-up steps are undone by
+            # the reset at the start of each binary search step.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    optimizer.zero_grad(set_to_none=True)
+                    optimize_step()
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            optimizer.zero_grad(set_to_none=True)
+            with torch.cuda.graph(graph):
+                static_out = optimize_step()
 
         for binary_search_step in range(binary_search_steps):
 
-            if not random_start:
-                z_delta = torch.zeros_like(z_orig, requires_grad=True)
+            with torch.no_grad():
+                if not random_start:
+                    z_delta.zero_()
+                else:
+                    # sample the noise directly on the device
+                    z_delta.normal_(0, 1e-2)
+            # cold restart of Adam, moments are rebuilt on the first step
+            if cuda_graph:
+                # the captured graph holds on to the state tensors
+                for state in optimizer.state.values():
+                    for value in state.values():
+                        value.zero_()
             else:
-                rand = np.random.randn(*input_shape) * 1e-2
-                z_delta = torch.tensor(
-                    rand, dtype=torch.float32, requires_grad=True, device=device)
-            loss_at_previous_check = torch.zeros(1, device=device) + INFTY
-
-            # create a new optimizer
-            optimizer = optim.Adam([z_delta], lr=learning_rate)
-            # optimizer = optim.SGD([z_delta], lr=learning_rate)
+                optimizer.state.clear()
+            loss_at_previous_check = INFTY
 
             for iteration in range(max_iterations):
-                optimizer.zero_grad()
-                x = to_model_space(z_orig + z_delta)
-                reps = dknn.get_activations(x, requires_grad=True)
-                loss, l2dist = self.loss_function(
-                    x, reps, guide_reps, dknn.layers, const, x_recon, device)
-                loss.backward()
-                optimizer.step()
-
-                if iteration % (np.ceil(max_iterations / 10)) == 0:
-                    print('    step: %d; loss: %.3f; l2dist: %.3f' %
-                          (iteration, loss.cpu().detach().numpy(),
-                           l2dist.mean().cpu().detach().numpy()))
+                if cuda_graph:
+                    graph.replay()
+                    x, loss, l2dist = static_out
+                else:
+                    optimizer.zero_grad()
+                    x, loss, l2dist = optimize_step()
+
                 # DEBUG:
                 # for i in range(5):
                 #     print(z_delta.grad[i].view(-1).norm().item())
 
-                if abort_early and iteration % (np.ceil(max_iterations / 10)) == 0:
-                    # after each tenth of the iterations, check progress
-                    if torch.gt(loss, .9999 * loss_at_previous_check):
-                        break  # stop Adam if there has not been progress
-                    loss_at_previous_check = loss
+                # only sync with the device on checkpoint iterations
+                if iteration % check_every == 0:
+                    loss_val = loss.item()
+                    print('    step: %d; loss: %.3f; l2dist: %.3f' %
+                          (iteration, loss_val, l2dist.mean().item()))
+                    if abort_early:
+                        # check progress
+                        if loss_val > .9999 * loss_at_previous_check:
+                            break  # stop Adam if there has not been progress
+                        loss_at_previous_check = loss_val
 
-            # check how many attacks have succeeded
             with torch.no_grad():
+                # check how many attacks have succeeded
                 is_adv = self.check_adv(dknn, x, label)
 
-            for i in range(batch_size):
                 # set new upper and lower bounds
-                if l2dist[i] > 0:
-                    lower_bound[i] = const[i]
-                else:
-                    upper_bound[i] = const[i]
-                    if is_adv[i]:
-                        x_adv[i] = x[i]
-                # set new const
-                if upper_bound[i] == INFTY:
-                    # exponential search if adv has not satisfied the
-                    # constraint once
-                    const[i] *= 10
-                elif lower_bound[i] == 0:
-                    const[i] /= 10
-                else:
-                    # binary search if adv has been found
-                    const[i] = (lower_bound[i] + upper_bound[i]) / 2
-
-            # check the current attack success rate
-            with torch.no_grad():
-                is_adv = self.check_adv(dknn, x_adv, label)
+                exceed = l2dist > 0
+                lower_bound = torch.where(exceed, const, lower_bound)
+                upper_bound = torch.where(exceed, upper_bound, const)
+                update = ~exceed & is_adv.bool()
+                x_adv[update] = x[update]
+                found |= update
+                # set new const: exponential search if adv has not satisfied
+                # the constraint once, binary search if adv has been found
+                const.copy_(torch.where(
+                    upper_bound == INFTY, const * 10,
+                    torch.where(lower_bound == 0, const / 10,
+                                (lower_bound + upper_bound) / 2)))
+
+            # report the current attack success rate, <x_adv> is only updated
+            # with adversarial examples so no need to classify it again
             print('binary step: %d; number of successful adv: %d/%d' %
-                  (binary_search_step, is_adv.sum(), batch_size))
+                  (binary_search_step, found.sum().item(), batch_size))
 
         return x_adv
 
@@ -217,51 +321,49 @@ class DKNNLinfAttack(object):
         return torch.tensor((y_pred != label).astype(np.float32)).to(dknn.device)
 
     @classmethod
-    def loss_function(cls, x, reps, guide_reps, layers, const, x_recon, device):
+    def loss_function(cls, x, reps, guide_reps, guide_norms2, layers, const,
+                      x_recon, adv_loss_buf):
         """Returns the loss averaged over the batch (first dimension of x) and
-        L-2 norm squared of the perturbation
+        L-2 norm squared of the perturbation. <guide_norms2> holds the squared
+        L-2 norm of every guide representation in <guide_reps>. Both are
+        computed once per attack and must be contiguous with shape
+        (batch_size, m, dim) and (batch_size, m) respectively. <adv_loss_buf>
+        is a preallocated (batch_size, len(layers)) tensor that is overwritten
+        with the loss of each layer.
         """
 
-        batch_size = x.size(0)
-        adv_loss = torch.zeros((batch_size, len(layers)), device=device)
-        # find squared L-2 distance between original samples and their
-        # adversarial examples at each layer
-        for l, layer in enumerate(layers):
-            rep = reps[layer].view(batch_size, 1, -1)
-            adv_loss[:, l] = ((rep - guide_reps[layer])**2).sum((1, 2))
-        # find L-inf norm squared of perturbation
-        dist = torch.max(torch.zeros_like(x), torch.abs(x - x_recon) - 0.1)
-        dist = (dist**2).view(batch_size, -1).mean(1)
-        # total_loss is sum of squared perturbation norm and squared distance
-        # of representations, multiplied by constant
-        total_loss = const * dist + adv_loss.mean(1)
-
-        return total_loss.mean(), dist.sqrt()
+        return _scripted_loss_function()(
+            x, [reps[layer] for layer in layers],
+            [guide_reps[layer] for layer in layers],
+            [guide_norms2[layer] for layer in layers],
+            const, x_recon, adv_loss_buf)
 
-    @staticmethod
-    def find_guide_samples(dknn, x, label, k=100, layer='relu1'):
+    def find_guide_samples(self, dknn, x, label, k=100, layer='relu1'):
         """Find k nearest neighbors to <x> that all have the same class but not
         equal to <label>
         """
         num_classes = dknn.num_classes
-        nn = torch.zeros((k, ) + x.size()).transpose(0, 1)
-        D, I = dknn.get_neighbors(
-            x, k=dknn.x_train.size(0), layers=[layer])[0]
-
-        for i, (d, ind) in enumerate(zip(D, I)):
-            mean_dist = np.zeros((num_classes, ))
-            for j in range(num_classes):
-                mean_dist[j] = np.mean(
-                    d[np.where(dknn.y_train[ind] == j)[0]][:k])
-            mean_dist[label[i]] += INFTY
-            nearest_label = mean_dist.argmin()
-            nn_ind = np.where(dknn.y_train[ind] == nearest_label)[0][:k]
-            nn[i] = dknn.x_train[ind[nn_ind]]
-
-        return nn
-
-    @classmethod
-    def find_guide_samples_v2(cls, dknn, x, label, k=100, layer='relu1'):
+        batch_size = x.size(0)
+        index = dknn.indices[dknn.layers.index(layer)]
+        rep_x = dknn.get_activations(x, requires_grad=False)[layer]
+        rep_x = rep_x.detach().cpu().numpy()
+
+        # search k nearest neighbors in each class separately instead of
+        # sorting distances to the entire training set
+        vals, nn_ind = [], []
+        for sel, ind_j in self.get_class_selectors(dknn):
+            D, I = self._search(index, sel, ind_j, rep_x, k)
+            vals.append(D)
+            nn_ind.append(I)
+        nn_ind = np.stack(nn_ind, 1)
+        mean_dist = np.stack(vals, 1).mean(2)
+        mean_dist[np.arange(batch_size), label] += INFTY
+        nearest_label = mean_dist.argmin(1)
+        nn_ind = nn_ind[np.arange(batch_size), nearest_label]
+
+        return dknn.x_train[nn_ind]
+
+    def find_guide_samples_v2(self, dknn, x, label, k=100, layer='relu1'):
         """Find the nearest neighbor to <x> that has a different label from
         <label>. Then find other <k> - 1 training samples that are closest to
         the neighbor and has the same class
@@ -269,30 +371,78 @@ class DKNNLinfAttack(object):
         # find nearest sample with different class
         nn = dknn.find_nn_diff_class(x, label)
         # now find k neighbors that has the same class as x_nn
-        x_nn = cls.find_nn_same_class(dknn, nn, k=k, layer=layer)
+        x_nn = self.find_nn_same_class(dknn, nn, k=k, layer=layer)
         return x_nn
 
-    @staticmethod
-    def find_nn_same_class(dknn, ind_x, k=100, layer='relu1'):
+    def find_nn_same_class(self, dknn, ind_x, k=100, layer='relu1'):
         """Find <k> training samples with the same class as and closest to the
         training sample with index <ind_x> in representation space at <layer>
         """
 
-        batch_size = ind_x.shape[0]
-        label = dknn.y_train[ind_x]
-        x_nn = torch.zeros((batch_size, k) + dknn.x_train[0].size())
-        _, I = dknn.get_neighbors(
-            dknn.x_train[ind_x], k=dknn.x_train.size(0), layers=[layer])[0]
-
-        for i, ind in enumerate(I):
-            nn_ind = np.where(dknn.y_train[ind] == label[i])[0][:k]
-            x_nn[i] = dknn.x_train[ind[nn_ind]]
+        ind_x = np.asarray(ind_x, dtype=np.int64)
+        label = self.get_y_train(dknn)[ind_x]
+        index = dknn.indices[dknn.layers.index(layer)]
+        # only encode the query samples, not the entire training set
+        rep_x = dknn.get_activations(
+            dknn.x_train[ind_x], requires_grad=False)[layer]
+        rep_x = rep_x.detach().cpu().numpy()
+        nn_ind = np.zeros((len(ind_x), k), dtype=np.int64)
+
+        # query samples of each class among training samples of that class
+        for j, (sel, ind_j) in enumerate(self.get_class_selectors(dknn)):
+            rows = np.where(label == j)[0]
+            if len(rows) == 0:
+                continue
+            nn_ind[rows] = self._search(index, sel, ind_j, rep_x[rows], k)[1]
+
+        return dknn.x_train[nn_ind]
+
+    def get_y_train(self, dknn):
+        """Return labels of the training samples of <dknn> as a numpy array.
+        The array is cached across calls.
+        """
+        self._reset_cache(dknn)
+        if self._y_train is None:
+            self._y_train = torch.as_tensor(dknn.y_train).cpu().numpy()
+        return self._y_train
+
+    def get_class_selectors(self, dknn):
+        """Return a list of (sel, ind) tuples, one per class, where ind holds
+        indices of the training samples of that class and sel is a faiss
+        selector that restricts a search on the indices of <dknn> to them.
+        The selectors are cached across calls.
+        """
+        self._reset_cache(dknn)
+        if self._class_selectors is None:
+            y_train = self.get_y_train(dknn)
+            self._class_selectors = []
+            for j in range(dknn.num_classes):
+                ind_j = np.where(y_train == j)[0].astype(np.int64)
+                sel = faiss.IDSelectorBatch(len(ind_j), faiss.swig_ptr(ind_j))
+                self._class_selectors.append((sel, ind_j))
+        return self._class_selectors
 
-        return x_nn
+    @staticmethod
+    def _search(index, sel, ind, x, k):
+        """Search <k> nearest neighbors of <x> in <index> among the training
+        samples picked by <sel> and return their squared distances and
+        indices in the training set. <ind> holds the indices picked by <sel>.
+        """
+        # faiss pads missing neighbors with label -1, which would silently
+        # index the last training sample
+        assert k <= len(ind), 'k is larger than the number of samples in class'
+        return index.search(x, k, params=faiss.SearchParameters(sel=sel))
+
+    def _reset_cache(self, dknn):
+        """Drop cached arrays if they were built from a different DkNN"""
+        if self._dknn is not dknn:
+            self._dknn = dknn
+            self._y_train = None
+            self._class_selectors = None
 
     @staticmethod
     def atanh(x):
-        return 0.5 * torch.log((1 + x) / (1 - x))
+        return torch.atanh(x)
 
     @staticmethod
     def sigmoid(x, a=1):
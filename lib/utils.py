@@ -2,7 +2,7 @@ import numpy as np
 import torch
 
 
-def compute_lid(x, x_train, k, exclude_self=False):
+def compute_lid(x, x_train, k, exclude_self=False, batch_size=256):
     """
     Calculate LID using the estimation from [1]
 
@@ -14,16 +14,23 @@ def compute_lid(x, x_train, k, exclude_self=False):
         x = x.view((x.size(0), -1))
         x_train = x_train.view((x_train.size(0), -1))
         lid = torch.zeros((x.size(0), ))
-
-        for i, x_cur in enumerate(x):
-            dist = (x_cur.view(1, -1) - x_train).norm(2, 1)
+        num_batches = int(np.ceil(x.size(0) / batch_size))
+
+        # compute distances for <batch_size> samples at a time to bound the
+        # size of the distance matrix
+        for i in range(num_batches):
+            begin, end = i * batch_size, (i + 1) * batch_size
+            # exact distances, the matmul expansion loses precision on the
+            # smallest distances that the estimate depends on
+            dist = torch.cdist(x[begin:end], x_train,
+                               compute_mode='donot_use_mm_for_euclid_dist')
             # `largest` should be True when using cosine distance
             if exclude_self:
-                topk_dist = dist.topk(k + 1, largest=False)[0][1:]
+                topk_dist = dist.topk(k + 1, largest=False)[0][:, 1:]
             else:
                 topk_dist = dist.topk(k, largest=False)[0]
-            mean_log = torch.log(topk_dist / topk_dist[-1]).mean()
-            lid[i] = -1 / mean_log
+            mean_log = torch.log(topk_dist / topk_dist[:, -1:]).mean(1)
+            lid[begin:end] = -1 / mean_log
         return lid
 
 
@@ -85,8 +92,5 @@ def compute_spnorm_batch(inputs, output):
             output[:, i].sum(), inputs, retain_graph=True)[0]
         jacobian[:, i, :] = grad.view(batch_size, input_dim)
 
-    norm = np.zeros((batch_size, ))
-    for i in range(batch_size):
-        norm[i] = np.linalg.norm(jacobian[i].detach().cpu().numpy(), 2)
-
-    return norm
+    # spectral norm of every jacobian in the batch at once
+    return np.linalg.norm(jacobian.detach().cpu().numpy(), 2, axis=(1, 2))